@@ -12,22 +12,259 @@ __author__ = "Dean Colcott <https://www.linkedin.com/in/deancolcott/>, Nicolas N
 
 import io
 import logging
+from dataclasses import dataclass, field
 
 import amazon_kinesis_video_consumer_library.ebmlite.util as emblite_utils
 
+# NumPy and Numba are optional - when installed the per-fragment SimpleBlock splitting runs
+# as a compiled kernel, otherwise a pure Python fallback is used.
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+
 # Init the logger.
 log = logging.getLogger(__name__)
 
 
+####################################################
+# MKV / EBML element type IDs
+#
+# Named once at module level so the hot loops compare against interned constants instead of
+# re-spelled hex literals (these exceed CPython's small-int cache).
+
+SEGMENT_ID = 0x18538067
+TAGS_ID = 0x1254C367
+TAG_ID = 0x7373
+SIMPLETAG_ID = 0x67C8
+TAGNAME_ID = 0x45A3
+TAGSTRING_ID = 0x4487
+TAGBINARY_ID = 0x4485
+CLUSTER_ID = 0x1F43B675
+SIMPLEBLOCK_ID = 0xA3
+TRACKS_ID = 0x1654AE6B
+TRACKENTRY_ID = 0xAE
+TRACKNAME_ID = 0x536E
+TRACKNUMBER_ID = 0xD7
+
+# Element types that carry a SimpleTag value - one set membership test covers them all and
+# new value types only need adding here.
+TAG_VALUE_IDS = frozenset({TAGSTRING_ID, TAGBINARY_ID})
+
+# The tag names KVS emits on every fragment, mapped to their KvsTags attribute slot.
+_KNOWN_TAG_ATTRS = {
+    "AWS_KINESISVIDEO_FRAGMENT_NUMBER": "fragment_number",
+    "AWS_KINESISVIDEO_CONTINUATION_TOKEN": "continuation_token",
+    "AWS_KINESISVIDEO_MILLIS_BEHIND_NOW": "millis_behind_now",
+    "AWS_KINESISVIDEO_PRODUCER_TIMESTAMP": "producer_timestamp",
+    "AWS_KINESISVIDEO_SERVER_TIMESTAMP": "server_timestamp",
+}
+
+
+class KvsTags:
+    """
+    Slotted container for the SimpleTags of a fragment. The KVS tag vocabulary is small and
+    fixed, so the known tags are stored in dedicated attribute slots - downstream access is a
+    plain attribute load with no per-fragment dict hashing - and any custom producer tags land
+    in the `other` dict.
+    """
+
+    __slots__ = (
+        "fragment_number",
+        "continuation_token",
+        "millis_behind_now",
+        "producer_timestamp",
+        "server_timestamp",
+        "other",
+    )
+
+    def __init__(self):
+        self.fragment_number = None
+        self.continuation_token = None
+        self.millis_behind_now = None
+        self.producer_timestamp = None
+        self.server_timestamp = None
+        self.other = {}
+
+    def items(self):
+        """
+        Yields (tag_name, tag_value) pairs for all tags found in the fragment, known and
+        custom alike - mirrors dict.items() for logging and iteration.
+        """
+        for tag_name, attr in _KNOWN_TAG_ATTRS.items():
+            value = getattr(self, attr)
+            if value is not None:
+                yield tag_name, value
+        yield from self.other.items()
+
+    def __repr__(self):
+        return f'KvsTags({dict(self.items())})'
+
+
+####################################################
+# EBML element ID dispatch tables
+#
+# The per-fragment DOM walk switches on element.id for every child element. A precomputed
+# {id: handler} dict gives a single O(1) lookup per element instead of a chain of
+# Python-level comparisons, which matters in the per-fragment hot path.
+
+
+def _handle_tags_element(fragment_info, element):
+    # For all SimpleTag types, save the TagName and values of TagString or TagBinary children.
+    for tags in element:
+        if tags.id == TAG_ID:
+            for tag_type in tags:
+                if tag_type.id == SIMPLETAG_ID:
+                    state = {}
+                    for tag_child in tag_type:
+                        handler = _SIMPLE_TAG_HANDLERS.get(tag_child.id)
+                        if handler:
+                            handler(state, tag_child)
+
+                    # As long as tag name was found record the Tag - known KVS tags go to
+                    # their attribute slot, custom producer tags to the `other` dict.
+                    tag_name = state.get("name")
+                    if tag_name:
+                        attr = _KNOWN_TAG_ATTRS.get(tag_name)
+                        if attr:
+                            setattr(fragment_info.tags, attr, state.get("value"))
+                        else:
+                            fragment_info.tags.other[tag_name] = state.get("value")
+
+
+def _handle_cluster_element(fragment_info, element):
+    # KVS fragments carry a single Cluster - only the first one encountered is processed.
+    if fragment_info.simple_blocks:
+        return
+    for el in element:
+        if el.id == SIMPLEBLOCK_ID:
+            fragment_info.simple_blocks.append((el.payloadOffset, el.size))
+
+
+def _handle_tracks_element(fragment_info, element):
+    for el in element:
+        if el.id == TRACKENTRY_ID:
+            state = {"name": "", "number": -1}
+            for e in el:
+                handler = _TRACK_ENTRY_HANDLERS.get(e.id)
+                if handler:
+                    handler(state, e)
+            if state["name"] == "AUDIO_FROM_CUSTOMER":
+                fragment_info.audio_from_customer_track = int(state["number"])
+            elif state["name"] == "AUDIO_TO_CUSTOMER":
+                fragment_info.audio_to_customer_track = int(state["number"])
+
+
+def _set_tag_name(state, element):
+    state["name"] = element.value
+
+
+def _set_tag_value(state, element):
+    state["value"] = element.value
+
+
+def _set_track_name(state, element):
+    state["name"] = element.value
+
+
+def _set_track_number(state, element):
+    state["number"] = element.value
+
+
+# Segment children of interest.
+_SEGMENT_HANDLERS = {
+    TAGS_ID: _handle_tags_element,
+    CLUSTER_ID: _handle_cluster_element,
+    TRACKS_ID: _handle_tracks_element,
+}
+
+# SimpleTag children - every tag-value type dispatches to the same handler.
+_SIMPLE_TAG_HANDLERS = {TAGNAME_ID: _set_tag_name}
+_SIMPLE_TAG_HANDLERS.update({tag_value_id: _set_tag_value for tag_value_id in TAG_VALUE_IDS})
+
+# TrackEntry children.
+_TRACK_ENTRY_HANDLERS = {
+    TRACKNAME_ID: _set_track_name,
+    TRACKNUMBER_ID: _set_track_number,
+}
+
+# Vint size lookup indexed by the first byte of the vint: the number of leading zero bits plus
+# one gives the total size in bytes. Entry 0 marks the invalid all-zeros byte (size > 8).
+_VINT_SIZE = bytes(9 - b.bit_length() if b else 0 for b in range(256))
+
+
+if np is not None:
+
+    _VINT_SIZE_NP = np.frombuffer(_VINT_SIZE, dtype=np.uint8)
+
+    @njit(cache=True)
+    def _split_blocks_kernel(buf, offsets, sizes, from_track, to_track, from_out, to_out):
+        """
+        Compiled kernel that scans each SimpleBlock in buf, decodes the track number vint and
+        copies the payload bytes into the preallocated output buffer for the matching track.
+        Returns the number of bytes written to each output.
+        """
+        from_cursor = 0
+        to_cursor = 0
+        for i in range(offsets.shape[0]):
+            offset = offsets[i]
+            size = sizes[i]
+            vint_size = _VINT_SIZE_NP[buf[offset]]
+            track_number = 0
+            for j in range(vint_size):
+                track_number = (track_number << 8) | buf[offset + j]
+            track_number &= (1 << (7 * vint_size)) - 1
+
+            # Skip the track number vint, 2 byte timestamp and 1 byte flags to get to the payload.
+            payload_start = offset + vint_size + 3
+            end = offset + size
+            payload_size = end - payload_start
+            if track_number == from_track:
+                from_out[from_cursor : from_cursor + payload_size] = buf[payload_start:end]
+                from_cursor += payload_size
+            elif track_number == to_track:
+                to_out[to_cursor : to_cursor + payload_size] = buf[payload_start:end]
+                to_cursor += payload_size
+
+        return from_cursor, to_cursor
+
+
+@dataclass
+class FragmentInfo:
+    """
+    Result of a single-pass parse of a MKV Fragment DOM by KvsFragementProcessor.parse_fragment().
+
+    **tags**: KvsTags
+        All SimpleTag elements found in the fragment - known KVS tags as attributes, custom
+        producer tags in the `other` dict.
+
+    **simple_blocks**: list
+        List of (payloadOffset, size) tuples, one per SimpleBlock element in the fragments Cluster.
+
+    **audio_from_customer_track / audio_to_customer_track**: int
+        MKV track numbers of the AUDIO_FROM_CUSTOMER and AUDIO_TO_CUSTOMER tracks respectively.
+    """
+
+    tags: KvsTags = field(default_factory=KvsTags)
+    simple_blocks: list = field(default_factory=list)
+    audio_from_customer_track: int = 0
+    audio_to_customer_track: int = 0
+
+
 class KvsFragementProcessor:
 
     ####################################################
     # Fragment processing functions
 
-    def get_fragment_tags(self, fragment_dom):
+    def parse_fragment(self, fragment_dom):
         """
         Parses a MKV Fragment Doc (of type ebmlite.core.MatroskaDocument) that is returned to the provided callback
-        from get_streaming_fragments() in this class and returns a dict of the SimpleTag elements found.
+        from get_streaming_fragments() in this class with a single walk of the Segment element children, collecting
+        the SimpleTags, the SimpleBlock offsets and the audio track numbers in one pass.
+
+        This is the preferred entry point for per-fragment processing as it avoids re-walking the DOM once
+        per item of interest (EBMLite materializes elements lazily on each iteration).
 
         ### Parameters:
 
@@ -36,73 +273,67 @@ class KvsFragementProcessor:
 
         ### Returns:
 
-            simple_tags: dict
-
-            Dictionary of all SimpleTag elements with format -  TagName<String> : TagValue <String | Binary>.
-
+            fragment_info: FragmentInfo
+                Collected tags, SimpleBlock offsets and audio track numbers for the fragment.
         """
 
         # Get the Segment Element of the Fragment DOM - error if not found
         segment_element = None
         for element in fragment_dom:
-            if element.id == 0x18538067:  # MKV Segment Element ID
+            if element.id == SEGMENT_ID:
                 segment_element = element
                 break
 
         if not segment_element:
             raise KeyError("Segment Element required but not found in fragment_doc")
 
-        # Save all of the SimpleTag elements in the Segment element
-        simple_tag_elements = []
+        fragment_info = FragmentInfo()
+
+        # Single pass over the Segment children dispatching on the element ID. Tags, Cluster and
+        # Tracks each appear at most once in a KVS fragment, so the walk stops as soon as all
+        # three have been handled - EBMLite parses children lazily, so breaking early skips
+        # materializing any remaining elements.
+        remaining_element_ids = set(_SEGMENT_HANDLERS)
         for element in segment_element:
-            if element.id == 0x1254C367:  # Tags element type ID
-                for tags in element:
-                    if tags.id == 0x7373:  # Tag element type ID
-                        for tag_type in tags:
-                            if tag_type.id == 0x67C8:  # SimpleTag element type ID
-                                simple_tag_elements.append(tag_type)
-
-        # For all SimpleTags types (ID: 0x67C8), save for TagName (ID: 0x7373) and values of TagString (ID:0x4487) or TagBinary (ID: 0x4485 )
-        simple_tags_dict = {}
-        for simple_tag in simple_tag_elements:
-
-            tag_name = None
-            tag_value = None
-            for element in simple_tag:
-                if element.id == 0x45A3:  # Tag Name element type ID
-                    tag_name = element.value
-                elif (
-                    element.id == 0x4487 or element.id == 0x4485
-                ):  # TagString and TagBinary element type IDs respectively
-                    tag_value = element.value
-
-            # As long as tag name was found add the Tag to the return dict.
-            if tag_name:
-                simple_tags_dict[tag_name] = tag_value
-
-        return simple_tags_dict
+            handler = _SEGMENT_HANDLERS.get(element.id)
+            if handler:
+                handler(fragment_info, element)
+                remaining_element_ids.discard(element.id)
+                if not remaining_element_ids:
+                    break
+
+        if (
+            fragment_info.audio_from_customer_track == 0
+            or fragment_info.audio_to_customer_track == 0
+        ):
+            log.error("Audio tracks not found in the fragment")
+            fragment_info.audio_from_customer_track = 1
+            fragment_info.audio_to_customer_track = 2
 
-    def get_simple_block_offset(self, fragment_dom):
-        # Get the Segment Element of the Fragment DOM - error if not found
-        segment_element = None
-        for element in fragment_dom:
-            if element.id == 0x18538067:  # MKV Segment Element ID
-                segment_element = element
-                break
-        if not segment_element:
-            raise KeyError("Segment Element required but not found in fragment_doc")
+        return fragment_info
 
-        # offset = 40
-        simple_block_elements = []
-        for element in segment_element:
-            if element.id == 0x1F43B675:
-                for el in element:
-                    if el.id == 0xA3:
-                        simple_block_elements.append((el.payloadOffset, el.size))
-                break
-            # else :
-            #     offset += int(element.length)
-        return simple_block_elements
+    def get_fragment_tags(self, fragment_dom):
+        """
+        Parses a MKV Fragment Doc (of type ebmlite.core.MatroskaDocument) that is returned to the provided callback
+        from get_streaming_fragments() in this class and returns the SimpleTag elements found.
+
+        ### Parameters:
+
+            **fragment_dom**: ebmlite.core.Document <ebmlite.core.MatroskaDocument>
+                The DOM like structure describing the fragment parsed by EBMLite.
+
+        ### Returns:
+
+            simple_tags: KvsTags
+
+            All SimpleTag elements found in the fragment - known KVS tags as attributes, custom
+            producer tags in the `other` dict. Iterate name/value pairs with .items().
+
+        """
+        return self.parse_fragment(fragment_dom).tags
+
+    def get_simple_block_offset(self, fragment_dom):
+        return self.parse_fragment(fragment_dom).simple_blocks
 
     def get_fragement_dom_pretty_string(self, fragment_dom):
         """
@@ -129,68 +360,80 @@ class KvsFragementProcessor:
         Returns a tuple (value, size) where 'value' is the extracted integer
         and 'size' is the size in bytes of the vint.
         """
-        first_byte = data[offset]
-        mask = 0x80
-        size = 1
-
-        while size <= 8 and not (first_byte & mask):
-            mask >>= 1
-            size += 1
-
-        if size > 8:
+        size = _VINT_SIZE[data[offset]]
+        if not size:
             raise ValueError("Invalid VINT size (>8 bytes)")
 
-        value = first_byte & (mask - 1)
-        for i in range(1, size):
-            value = (value << 8) | data[offset + i]
+        # Decode all bytes in one C-level conversion, then mask off the length-descriptor bit.
+        value = int.from_bytes(data[offset : offset + size], "big") & (
+            (1 << (7 * size)) - 1
+        )
 
         return value, size
 
-    def extract_simpleblock_data(self, byte_array):
-        """
-        Extracts the track number and the data payload from a Matroska SimpleBlock bytearray.
+    def get_audio_tracks(self, fragment_dom):
+        fragment_info = self.parse_fragment(fragment_dom)
+        return (
+            fragment_info.audio_from_customer_track,
+            fragment_info.audio_to_customer_track,
+        )
+
+    def split_simple_blocks(self, fragment_bytes, simple_blocks, from_track, to_track):
         """
-        # Parse track number
-        track_number, size = self.parse_vint(byte_array, 0)
+        Splits the SimpleBlock payloads in a raw fragment into one bytes object per audio track.
 
-        # Skip the track number and timestamp (2 bytes) to get to the payload
-        payload_offset = (
-            size + 2 + 1
-        )  # 2 bytes for the timestamp and 1 byte for the flags
+        Runs as a compiled Numba kernel when NumPy and Numba are installed, otherwise falls back
+        to a pure Python loop over memoryview slices.
 
-        # Read the rest of the data as the payload
-        data_payload = byte_array[payload_offset:]
+        ### Parameters:
 
-        return track_number, data_payload
+            **fragment_bytes**: bytearray
+                A ByteArray with raw bytes from exactly one fragment.
 
-    def get_audio_tracks(self, fragment_dom):
-        audio_from_customer_track, audio_to_customer_track = 0, 0
-        # Get the Segment Element of the Fragment DOM - error if not found
-        segment_element = None
-        for element in fragment_dom:
-            if element.id == 0x18538067:  # MKV Segment Element ID
-                segment_element = element
-                break
-        if not segment_element:
-            raise KeyError("Segment Element required but not found in fragment_doc")
+            **simple_blocks**: list
+                List of (payloadOffset, size) tuples as returned in FragmentInfo.simple_blocks.
 
-        for element in segment_element:
-            if element.id == 0x1654AE6B:  # Tracks
-                for el in element:
-                    if el.id == 0xAE:
-                        track_number = -1
-                        track_name = ""
-                        for e in el:
-                            if e.id == 0x536E:  # TrackName
-                                track_name = e.value
-                            elif e.id == 0xD7:  # TrackNumber
-                                track_number = e.value
-                        if track_name == "AUDIO_FROM_CUSTOMER":
-                            audio_from_customer_track = track_number
-                        elif track_name == "AUDIO_TO_CUSTOMER":
-                            audio_to_customer_track = track_number
-        if audio_from_customer_track == 0 or audio_to_customer_track == 0:
-            log.error("Audio tracks not found in the fragment")
-            audio_from_customer_track = 1
-            audio_to_customer_track = 2
-        return int(audio_from_customer_track), int(audio_to_customer_track)
+            **from_track / to_track**: int
+                MKV track numbers of the AUDIO_FROM_CUSTOMER and AUDIO_TO_CUSTOMER tracks.
+
+        ### Returns:
+
+            (from_payload, to_payload): (bytes, bytes)
+                Concatenated SimpleBlock payload bytes for each track.
+        """
+        if not simple_blocks:
+            return b"", b""
+
+        if np is not None:
+            buf = np.frombuffer(fragment_bytes, dtype=np.uint8)
+            offsets = np.array([block[0] for block in simple_blocks], dtype=np.int64)
+            sizes = np.array([block[1] for block in simple_blocks], dtype=np.int64)
+            # Total block size is an upper bound on the payload bytes per track.
+            max_payload = int(sizes.sum())
+            from_out = np.empty(max_payload, dtype=np.uint8)
+            to_out = np.empty(max_payload, dtype=np.uint8)
+            from_written, to_written = _split_blocks_kernel(
+                buf, offsets, sizes, from_track, to_track, from_out, to_out
+            )
+            return from_out[:from_written].tobytes(), to_out[:to_written].tobytes()
+
+        # Pure Python fallback: collect zero-copy memoryview slices and join once per track.
+        # The vint decode is inlined here to avoid a method call and tuple return per block.
+        fragment_view = memoryview(fragment_bytes)
+        vint_size_table = _VINT_SIZE
+        from_bytes = int.from_bytes
+        from_parts = []
+        to_parts = []
+        for offset, size in simple_blocks:
+            vint_size = vint_size_table[fragment_bytes[offset]]
+            track_number = from_bytes(
+                fragment_bytes[offset : offset + vint_size], "big"
+            ) & ((1 << (7 * vint_size)) - 1)
+            # Skip the track number vint, 2 byte timestamp and 1 byte flags to get to the payload.
+            payload_start = offset + vint_size + 3
+            if track_number == from_track:
+                from_parts.append(fragment_view[payload_start : (offset + size)])
+            elif track_number == to_track:
+                to_parts.append(fragment_view[payload_start : (offset + size)])
+
+        return b"".join(from_parts), b"".join(to_parts)
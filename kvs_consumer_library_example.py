@@ -6,13 +6,15 @@ __version__ = "0.0.2"
 __status__ = "Development"
 __author__ = "Dean Colcott <https://www.linkedin.com/in/deancolcott/>, Nicolas Neudeck <https://www.linkedin.com/in/nicolasneudeck/>"
 
-from io import BytesIO
 import os
 import sys
 import time
+import wave
+import queue
 import boto3
 import logging
-from pydub import AudioSegment
+import threading
+import numpy as np
 from amazon_kinesis_video_consumer_library.kinesis_video_streams_parser import KvsConsumerLibrary
 from amazon_kinesis_video_consumer_library.kinesis_video_fragment_processor import KvsFragementProcessor
 
@@ -33,6 +35,9 @@ class KvsPythonConsumerExample:
     Example class to demonstrate usage the AWS Kinesis Video Streams KVS) Consumer Library for Python.
     '''
 
+    # Seconds of audio per byte of 8 kHz 16-bit PCM.
+    _SECONDS_PER_BYTE = 1.0 / (2.0 * 8000.0)
+
     def __init__(self):
         '''
         Initialize the KVS clients as needed. The KVS Comsumer Library intentionally does not abstract 
@@ -55,14 +60,29 @@ class KvsPythonConsumerExample:
         self.session = boto3.Session(region_name=REGION)
         self.kvs_client = self.session.client("kinesisvideo")
 
-        # Initialize the audio track bytearrays
-        self.audio_to_customer = bytearray()
-        self.audio_from_customer = bytearray()
+        # Stream the raw PCM for each audio track to disk as it arrives. Accumulating in memory
+        # grows unboundedly with call length; appending to disk keeps memory use constant.
+        self.audio_to_customer_path = 'audio_to_customer.raw'
+        self.audio_from_customer_path = 'audio_from_customer.raw'
+        # A 1 MiB write buffer batches the small per-fragment payloads into few kernel writes.
+        self._audio_to_customer_file = open(self.audio_to_customer_path, 'wb', buffering=1 << 20)
+        self._audio_from_customer_file = open(self.audio_from_customer_path, 'wb', buffering=1 << 20)
 
         self.current_audio_length = 0.0
 
+        # Cached (from_customer, to_customer) track numbers - the MKV Tracks metadata is fixed
+        # for the life of a KVS stream so it only needs to be parsed from the first fragment.
+        self._audio_tracks = None
+
         self.stream_stopped = False
 
+        # Post-process fragments on a dedicated worker thread so slow processing (DOM walks,
+        # disk writes) never stalls the KvsConsumerLibrary reader thread. The bounded queue
+        # applies back-pressure if processing falls behind the stream.
+        self._fragment_queue = queue.Queue(maxsize=8)
+        self._fragment_worker = threading.Thread(target=self._fragment_worker_loop, daemon=True)
+        self._fragment_worker.start()
+
     ####################################################
     # Main process loop
     def service_loop(self):
@@ -165,86 +185,126 @@ class KvsPythonConsumerExample:
                 A DOM like structure of the parsed fragment providing searchable list of EBML elements and MetaData in the Fragment
 
             **fragment_receive_duration**: float
-                The time in seconds that the fragment took for the streaming data to be received and processed. 
-        
+                The time in seconds that the fragment took for the streaming data to be received and processed.
+
+        '''
+
+        # Hand the fragment off to the worker thread - this callback runs on the
+        # KvsConsumerLibrary reader thread and must return quickly to keep up with the stream.
+        self._fragment_queue.put((stream_name, fragment_bytes, fragment_dom, fragment_receive_duration))
+
+    def _fragment_worker_loop(self):
+        '''
+        Worker thread loop that pops fragments off the queue and post-processes them.
+        Exits when the None sentinel is queued by on_stream_read_complete().
+        '''
+        while True:
+            work_item = self._fragment_queue.get()
+            if work_item is None:
+                break
+            # Last-resort guard: an uncaught exception would kill the worker permanently,
+            # after which the bounded queue fills and wedges the reader thread in put().
+            try:
+                self._process_fragment(*work_item)
+            except Exception as err:
+                log.error(f'_process_fragment Error: {err}')
+
+    def _process_fragment(self, stream_name, fragment_bytes, fragment_dom, fragment_receive_duration):
+        '''
+        Post-processes a single fragment - runs on the worker thread.
         '''
-        
-        try:
-            # Log the arrival of a fragment. 
-            # use stream_name to identify fragments where multiple instances of the KvsConsumerLibrary are running on different streams.
-            log.info(f'\n\n##########################\nFragment Received on Stream: {stream_name}\n##########################')
-            
-            # Print the fragment receive and processing duration as measured by the KvsConsumerLibrary
-            log.info('')
-            log.info(f'####### Fragment Receive and Processing Duration: {fragment_receive_duration} Secs')
 
-            # Get the fragment tags and save in local parameter.
-            self.last_good_fragment_tags = self.kvs_fragment_processor.get_fragment_tags(fragment_dom)
+        # Log the arrival of a fragment.
+        # use stream_name to identify fragments where multiple instances of the KvsConsumerLibrary are running on different streams.
+        log.info(f'\n\n##########################\nFragment Received on Stream: {stream_name}\n##########################')
 
-            # Get the fragment number and save in local parameter.
-            stream_fragment_number = self.last_good_fragment_tags[
-                "AWS_KINESISVIDEO_CONTINUATION_TOKEN"
-            ]
+        # Print the fragment receive and processing duration as measured by the KvsConsumerLibrary
+        log.info('')
+        log.info(f'####### Fragment Receive and Processing Duration: {fragment_receive_duration} Secs')
 
-            ##### Log Time Deltas:  local time Vs fragment SERVER and PRODUCER Timestamp:
+        # Parse the fragment DOM once - collects the tags, SimpleBlock offsets and audio track
+        # numbers in a single pass. Only the parse itself is guarded - a malformed fragment is
+        # logged and skipped without masking later errors. EBMLite parses lazily, so corrupt or
+        # truncated bytes can raise a variety of exception types during the walk.
+        try:
+            fragment_info = self.kvs_fragment_processor.parse_fragment(fragment_dom)
+        except Exception as err:
+            log.error(f'Failed to parse fragment DOM: {err}')
+            return
+
+        # Get the fragment tags and save in local parameter.
+        self.last_good_fragment_tags = fragment_info.tags
+
+        ##### Log Time Deltas:  local time Vs fragment SERVER and PRODUCER Timestamp:
+        # Guarded separately - missing or malformed tags should not stop the audio extraction below.
+        try:
             time_now = time.time()
-            kvs_ms_behind_live = float(self.last_good_fragment_tags['AWS_KINESISVIDEO_MILLIS_BEHIND_NOW'])
-            producer_timestamp = float(self.last_good_fragment_tags['AWS_KINESISVIDEO_PRODUCER_TIMESTAMP'])
-            server_timestamp = float(self.last_good_fragment_tags['AWS_KINESISVIDEO_SERVER_TIMESTAMP'])
-            
+            kvs_ms_behind_live = float(self.last_good_fragment_tags.millis_behind_now)
+            producer_timestamp = float(self.last_good_fragment_tags.producer_timestamp)
+            server_timestamp = float(self.last_good_fragment_tags.server_timestamp)
+
             log.info('')
             log.info('####### Timestamps and Delta: ')
             log.info(f'KVS Reported Time Behind Live {kvs_ms_behind_live} mS')
             log.info(f'Local Time Diff to Fragment Producer Timestamp: {round(((time_now - producer_timestamp)*1000), 3)} mS')
             log.info(f'Local Time Diff to Fragment Server Timestamp: {round(((time_now - server_timestamp)*1000), 3)} mS')
+        except (KeyError, TypeError, ValueError) as err:
+            log.error(f'Fragment timestamp tags missing or malformed: {err}')
+
+        ###########################################
+        # 1) Extract and print the MKV Tags in the fragment
+        ###########################################
+        # Get the fragment MKV Tags (Meta-Data). KVS allows these to be set per fragment to convey some information
+        # about the attached frames such as location or Computer Vision labels. Here we just log them!
+        # A single joined record instead of one per tag keeps the logging-handler cost O(1).
+        if log.isEnabledFor(logging.INFO):
+            log.info(
+                '\n####### Fragment MKV Tags:\n%s',
+                '\n'.join(f'{key} : {value}' for key, value in self.last_good_fragment_tags.items()),
+            )
 
-            ###########################################
-            # 1) Extract and print the MKV Tags in the fragment
-            ###########################################
-            # Get the fragment MKV Tags (Meta-Data). KVS allows these to be set per fragment to convey some information 
-            # about the attached frames such as location or Computer Vision labels. Here we just log them!
-            log.info('')
-            log.info('####### Fragment MKV Tags:')
-            for key, value in self.last_good_fragment_tags.items():
-                log.info(f'{key} : {value}')
-
-            ###########################################
-            # 2) Pretty Print the entire fragment DOM structure
-            # ###########################################
-            # Get and log the the pretty print string for entire fragment DOM structure from EBMLite parsing.
-            log.info('')
-            log.info('####### Pretty Print Fragment DOM: #######')
-            pretty_frag_dom = self.kvs_fragment_processor.get_fragement_dom_pretty_string(fragment_dom)
-            log.info(pretty_frag_dom)
+        ###########################################
+        # 2) Pretty Print the entire fragment DOM structure
+        # ###########################################
+        # Building the pretty print string is a full recursive DOM walk so only do it when
+        # DEBUG logging is actually enabled.
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                '####### Pretty Print Fragment DOM: #######\n%s',
+                self.kvs_fragment_processor.get_fragement_dom_pretty_string(fragment_dom),
+            )
 
-            
-            ###########################################
-            # 3) add audio to customer and agent
-            ###########################################
-            simple_block_elements = self.kvs_fragment_processor.get_simple_block_offset(
-                fragment_dom
+        ###########################################
+        # 3) add audio to customer and agent
+        ###########################################
+        simple_block_elements = fragment_info.simple_blocks
+        if self._audio_tracks is None:
+            self._audio_tracks = (
+                fragment_info.audio_from_customer_track,
+                fragment_info.audio_to_customer_track,
             )
-            audio_from_customer_track, audio_to_customer_track = (
-                self.kvs_fragment_processor.get_audio_tracks(fragment_dom)
+        audio_from_customer_track, audio_to_customer_track = self._audio_tracks
+        log.debug(f"audio_from_customer_track: {audio_from_customer_track}")
+        log.debug(f"audio_to_customer_track: {audio_to_customer_track}")
+        # Split the SimpleBlock payloads per track in one call - runs as a compiled kernel
+        # when NumPy and Numba are installed.
+        from_customer_payload, to_customer_payload = (
+            self.kvs_fragment_processor.split_simple_blocks(
+                fragment_bytes,
+                simple_block_elements,
+                audio_from_customer_track,
+                audio_to_customer_track,
             )
-            log.debug(f"audio_from_customer_track: {audio_from_customer_track}")
-            log.debug(f"audio_to_customer_track: {audio_to_customer_track}")
-            for offset, size in simple_block_elements:
-                track_number, data_payload = (
-                    self.kvs_fragment_processor.extract_simpleblock_data(
-                        fragment_bytes[offset : (offset + size)]
-                    )
-                )
-                if track_number == audio_from_customer_track:
-                    self.audio_from_customer.extend(data_payload)
-                elif track_number == audio_to_customer_track:
-                    self.audio_to_customer.extend(data_payload)
-                length = float(size) / 2.0 / 8000.0
-                self.current_audio_length += length
-                log.debug(f"Audio Length: {self.current_audio_length}")
-
-        except Exception as err:
-            log.error(f'on_fragment_arrived Error: {err}')
+        )
+        if from_customer_payload:
+            self._audio_from_customer_file.write(from_customer_payload)
+        if to_customer_payload:
+            self._audio_to_customer_file.write(to_customer_payload)
+
+        # One accumulation per fragment rather than two float divisions per block.
+        total_block_size = sum(size for _, size in simple_block_elements)
+        self.current_audio_length += total_block_size * self._SECONDS_PER_BYTE
+        log.debug("Audio Length: %s", self.current_audio_length)
     
     def on_stream_read_complete(self, stream_name):
         '''
@@ -266,71 +326,49 @@ class KvsPythonConsumerExample:
         '''
 
         # Do something here to tell the application that reading from the stream ended gracefully.
+        # Let the worker drain any queued fragments before closing out the audio files.
+        self._fragment_queue.put(None)
+        self._fragment_worker.join()
+
         print(f'Read Media on stream: {stream_name} Completed successfully - Last Fragment Tags: {self.last_good_fragment_tags}')
-        self.save_audio_files(self.audio_to_customer, self.audio_from_customer)
+        self.save_audio_files()
         self.stream_stopped = True
 
-    def save_audio_files(self, audio_to_customer, audio_from_customer):
-        min_length = min(len(audio_to_customer), len(audio_from_customer))
-        channels = 1
-        sample_width = 2
-        sample_rate = 8000
-        audio_to_customer_audio_stream = BytesIO(bytes(audio_to_customer[:min_length]))
-        audio_to_customer_audio_segment = AudioSegment.from_file(
-            audio_to_customer_audio_stream,
-            format="raw",
-            codec="pcm_s16le",
-            frame_rate=sample_rate,
-            channels=channels,
-            sample_width=sample_width,
-        )
+    def save_audio_files(self):
+        # Close the raw PCM streams written during fragment processing before reading them back.
+        self._audio_to_customer_file.close()
+        self._audio_from_customer_file.close()
 
-        audio_from_customer_audio_stream = BytesIO(
-            bytes(audio_from_customer[:min_length])
-        )
-        audio_from_customer_audio_segment = AudioSegment.from_file(
-            audio_from_customer_audio_stream,
-            format="raw",
-            codec="pcm_s16le",
-            frame_rate=sample_rate,
-            channels=channels,
-            sample_width=sample_width,
+        # Truncate both sides to the shorter track so the channels stay aligned.
+        min_length = min(
+            os.path.getsize(self.audio_to_customer_path),
+            os.path.getsize(self.audio_from_customer_path),
         )
+        sample_width = 2
+        sample_rate = 8000
+        num_samples = min_length // sample_width
 
-        # if the audio is not the same length, we need to add silence to the shorter one
-        max_length = max(
-            len(audio_to_customer_audio_segment), len(audio_from_customer_audio_segment)
+        # The tracks are raw 8 kHz signed 16-bit little-endian PCM - interleave them into a
+        # stereo WAV directly with NumPy rather than going through an audio codec library.
+        audio_from_customer = np.fromfile(
+            self.audio_from_customer_path, dtype='<i2', count=num_samples
         )
-        audio_to_customer_audio_segment = (
-            audio_to_customer_audio_segment
-            + AudioSegment.silent(
-                duration=max_length - len(audio_to_customer_audio_segment),
-                frame_rate=sample_rate,
-            )
+        audio_to_customer = np.fromfile(
+            self.audio_to_customer_path, dtype='<i2', count=num_samples
         )
-        audio_from_customer_audio_segment = (
-            audio_from_customer_audio_segment
-            + AudioSegment.silent(
-                duration=max_length - len(audio_from_customer_audio_segment),
-                frame_rate=sample_rate,
-            )
-        )
-
-
-        # MONO (agent and customer audio combined)
-        # combined_audio1_file_name = "combined_mono_audio.wav"
-        # combined_audio1 = audio_to_customer_audio_segment.overlay(
-        #     audio_from_customer_audio_segment
-        # )
-        # combined_audio1.export(combined_audio1_file_name, format='wav')
 
         # STEREO (agent on left channel, customer on right channel - good for transcription)
         combined_audio_file_name = "combined_stereo_audio.wav"
+        stereo_audio = np.empty((num_samples, 2), dtype='<i2')
+        stereo_audio[:, 0] = audio_from_customer
+        stereo_audio[:, 1] = audio_to_customer
         try:
-            combined_audio = AudioSegment.from_mono_audiosegments(
-                audio_from_customer_audio_segment, audio_to_customer_audio_segment
-            )
-            combined_audio.export(combined_audio_file_name, format='wav')
+            with wave.open(combined_audio_file_name, 'wb') as combined_audio_file:
+                combined_audio_file.setnchannels(2)
+                combined_audio_file.setsampwidth(sample_width)
+                combined_audio_file.setframerate(sample_rate)
+                # .data exposes the interleaved samples as a zero-copy memoryview.
+                combined_audio_file.writeframes(stereo_audio.data)
         except Exception as e:
             log.error(f"Error combining audio: {e}")
         
@@ -358,7 +396,7 @@ class KvsPythonConsumerExample:
         # Can choose to restart the KvsConsumerLibrary thread at the last received fragment with below example StartSelector
         #StartSelector={
         #    'StartSelectorType': 'FRAGMENT_NUMBER',
-        #    'AfterFragmentNumber': self.last_good_fragment_tags['AWS_KINESISVIDEO_CONTINUATION_TOKEN'],
+        #    'AfterFragmentNumber': self.last_good_fragment_tags.continuation_token,
         #}
 
         # Here we just log the error 